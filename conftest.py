@@ -26,6 +26,29 @@ def pytest_addoption(parser):
         default="input_question",
         help="CSV field name for the input question"
     )
+    parser.addoption(
+        "--record-video",
+        action="store_true",
+        default=False,
+        help="Record a video of the UI verification and convert it to a GIF"
+    )
+
+class GlobalConfig:
+    """Thin wrapper exposing the pytest config to test modules via pytest.global_test_context."""
+    def __init__(self, config):
+        self.config = config
+        # pytest's cross-run cache (.pytest_cache); None when the cacheprovider plugin is disabled
+        self.cache = getattr(config, "cache", None)
+
+    def getoption(self, option_name):
+        return self.config.getoption(option_name)
+
+def pytest_configure(config):
+    """
+    Publishes the config before collection so module-level code such as
+    load_test_data() (used as fixture params) can read options and the cache.
+    """
+    pytest.global_test_context = GlobalConfig(config)
 
 @pytest.fixture(scope="session", autouse=True)
 def session_cleanup(request):
@@ -57,13 +80,6 @@ def global_test_context(request, session_cleanup):
     This fixture now explicitly depends on 'session_cleanup', guaranteeing
     it runs AFTER the temporary directory has been cleaned.
     """
-    class GlobalConfig:
-        def __init__(self, config):
-            self.config = config
-        
-        def getoption(self, option_name):
-            return self.config.getoption(option_name)
-
     pytest.global_test_context = GlobalConfig(request.config)
     
     allure_results_dir = request.config.getoption("--alluredir") or "allure-results"
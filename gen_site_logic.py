@@ -65,12 +65,16 @@ def _run_command_util(cmd_list, cwd, results_dict, timeout=120, check_on_error=T
     
     return process_result["success"]
 
+# PERFORMANCE: --prefer-offline resolves packages from pnpm's shared content-addressable store
+# (shared by the template and every test site) and only contacts the registry on a cache miss.
+PNPM_INSTALL_CMD = ['pnpm', 'install', '--strict-peer-dependencies=false', '--prefer-offline']
+
 # --- Core Logic Functions ---
 
 def create_golden_template(base_tmp_dir: str, repo_url: str) -> str | None:
     """
     PERFORMANCE: Clones the template and installs dependencies ONCE per session.
-    IMPORTANT: It leaves the .git directory intact to enable fast local clones.
+    The .git directory is removed so per-test copies of the template are clean.
     """
     project_folder_name = "nextjs_golden_template"
     project_path = os.path.join(base_tmp_dir, project_folder_name)
@@ -92,15 +96,14 @@ def create_golden_template(base_tmp_dir: str, repo_url: str) -> str | None:
     )
     if not clone_success: return None
     
-    # --- KEY CHANGE: DO NOT REMOVE the .git directory ---
-    # The .git directory is required for fast local cloning.
-    # git_dir_path = os.path.join(project_path, ".git")
-    # if os.path.exists(git_dir_path):
-    #     shutil.rmtree(git_dir_path)
+    # Strip .git once here instead of after every per-test copy.
+    git_dir_path = os.path.join(project_path, ".git")
+    if os.path.exists(git_dir_path):
+        shutil.rmtree(git_dir_path)
 
     # Install dependencies using pnpm, which will create a link-based node_modules
     install_success = _run_command_util(
-        ['pnpm', 'install', '--strict-peer-dependencies=false'],
+        PNPM_INSTALL_CMD,
         cwd=project_path, results_dict=results, command_name="pnpm Install (template)"
     )
     if not install_success: return None
@@ -153,13 +156,26 @@ def process_generated_site(tesslate_response_content: str, project_final_path: s
     # This step is essential to validate if the LLM correctly managed package.json
     stage_name_pnpm_install = "pnpm Install"
     results["project_setup_stages"].append(stage_name_pnpm_install)
-    pnpm_install_success = _run_command_util(
-        ['pnpm', 'install', '--strict-peer-dependencies=false'],
-        cwd=project_final_path,
-        results_dict=results,
-        command_name=stage_name_pnpm_install,
-        check_on_error=True # This is a critical step
-    )
+    # PERFORMANCE: The project is a copy of the installed golden template, so when the LLM did not
+    # touch the dependency manifests there is nothing new to install.
+    dependency_manifests = {os.path.normpath(os.path.join(project_final_path, name))
+                            for name in ("package.json", "pnpm-lock.yaml")}
+    dependencies_changed = any(path in dependency_manifests for path in llm_modified_files)
+    if not dependencies_changed and os.path.isdir(os.path.join(project_final_path, "node_modules")):
+        print(f"[{time.strftime('%H:%M:%S')}] Dependencies unchanged from the template. Skipping {stage_name_pnpm_install}.")
+        results["command_outputs_map"][stage_name_pnpm_install] = {
+            "stdout": "Skipped: package.json and pnpm-lock.yaml are unchanged from the pre-installed template.",
+            "stderr": "", "returncode": 0, "duration": 0, "success": True
+        }
+        pnpm_install_success = True
+    else:
+        pnpm_install_success = _run_command_util(
+            PNPM_INSTALL_CMD,
+            cwd=project_final_path,
+            results_dict=results,
+            command_name=stage_name_pnpm_install,
+            check_on_error=True # This is a critical step
+        )
     results["pnpm_install_success"] = pnpm_install_success
     if not pnpm_install_success:
         # No point in continuing if dependencies are broken
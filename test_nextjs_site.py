@@ -4,26 +4,61 @@ import pytest
 import os
 import time
 import requests
-from playwright.sync_api import Playwright
+import urllib.parse
+import atexit
+from requests.adapters import HTTPAdapter
+from playwright.sync_api import Browser, Playwright, TimeoutError as PlaywrightTimeoutError
 import subprocess
 import glob
 import csv
+import io
+import mmap
 import allure
 import json
 from pytest_assume.plugin import assume
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import socket
 import contextlib
 from datetime import datetime
 import shutil
+import functools
+from filelock import FileLock
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import re
+import signal
+import select
 
 # Import functions from your business logic module
 # Make sure gen_site_logic.py is the correct filename and path
 from gen_site_logic import process_generated_site, create_golden_template
 
 # --- CONFIGURATION ---
-RECORD_VIDEO = False
 # The repository URL is now centralized here for consistency
 NEXTJS_REPO_URL = "https://github.com/dterenin/weby-nextjs-template"
+# Sniff the CSV dialect (delimiter/quoting) instead of assuming standard comma-separated input
+SNIFF_CSV_DIALECT = os.getenv("SNIFF_CSV_DIALECT", "false").lower() == "true"
+CSV_SNIFF_SAMPLE_SIZE = 8192
+# Dev server ports: each xdist worker uses its own block of ports starting here
+DEV_SERVER_PORT_RANGE_START = 3100
+DEV_SERVER_PORTS_PER_WORKER = 100
+# Template copies each worker prepares ahead of its next tests
+TEMPLATE_PREFETCH_COPIES = 2
+# PERFORMANCE: JPEG screenshots are several times smaller than PNG and cheaper to encode
+SCREENSHOT_JPEG_QUALITY = 70
+# Marker of an LLM file edit; only CSV responses containing it become test cases
+EDIT_BLOCK_MARKER = '<Edit filename="'
+# PERFORMANCE: Videos are captured at the GIF's output size, so ffmpeg does not have to downscale them
+VIDEO_RECORD_SIZE = {'width': 640, 'height': 360}
+# Only the most recent browser console messages are kept for the report
+CONSOLE_LOG_MAX_MESSAGES = 500
+# PERFORMANCE: Third-party requests of these types, or to these hosts, are aborted during UI checks
+BLOCKED_THIRD_PARTY_RESOURCE_TYPES = frozenset({"font", "media"})
+BLOCKED_THIRD_PARTY_URL_SUBSTRINGS = ("analytics", "googletagmanager", "doubleclick", "hotjar", "segment.io")
 
 # Fallback LLM response for when CSV loading fails
 LLM_TEST_RESPONSE_FALLBACK = """
@@ -43,12 +78,93 @@ export default function HomePage() {
 </Edit>
 """
 
+# Substrings in the rendered page that indicate a broken build or runtime crash.
+CRITICAL_ERROR_SUBSTRINGS = [
+    "cannot resolve", "module not found", "typeerror:", "referenceerror:", "syntaxerror:",
+    "unhandled runtime error", "application error: a client-side exception has occurred",
+    "server error", "compilation failed", "failed to compile",
+]
+# PERFORMANCE: Runs inside the browser so only the matched substrings cross the CDP bridge,
+# instead of serializing the whole DOM with page.content() and scanning it in Python.
+# A single case-insensitive regex pass avoids a lowercased copy of the page and one scan per substring.
+FIND_CRITICAL_ERRORS_JS = r"""(substrings) => {
+    const pattern = substrings.map(s => s.replace(/[.*+?^${}()|[\]\\]/g, '\\$&')).join('|');
+    const found = new Set();
+    for (const match of document.documentElement.outerHTML.matchAll(new RegExp(pattern, 'gi'))) {
+        found.add(match[0].toLowerCase());
+    }
+    return [...found];
+}"""
+
+# Scrolls to `top` (or the bottom of the page when null) and resolves once the next frame has painted.
+SCROLL_AND_SETTLE_JS = """(top) => new Promise(resolve => {
+    window.scrollTo({ top: top === null ? document.body.scrollHeight : top });
+    requestAnimationFrame(() => requestAnimationFrame(resolve));
+})"""
+
+# PERFORMANCE: Shared keep-alive session for readiness probes, so polling reuses one connection.
+_PROBE_SESSION = requests.Session()
+_PROBE_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=0))
+atexit.register(_PROBE_SESSION.close)
+
+def dump_results_json(results):
+    """Pretty-prints the process results, using orjson's C encoder when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS,
+                            default=lambda o: '<not serializable>')
+    return json.dumps(results, indent=2, default=lambda o: '<not serializable>')
+
+def attach_server_logs(stdout_path, stderr_path):
+    """Attaches the non-empty server log files by path, without reading them into memory."""
+    for log_path, log_name in ((stdout_path, "Server STDOUT"), (stderr_path, "Server STDERR")):
+        if os.path.getsize(log_path) > 0:
+            allure.attach.file(log_path, name=log_name, attachment_type=allure.attachment_type.TEXT)
+
+@functools.lru_cache(maxsize=1)
+def _base_env() -> dict:
+    """Snapshot of os.environ taken once; os.environ decodes every entry on each copy."""
+    return os.environ.copy()
+
+def dev_server_env(port) -> dict:
+    """Environment for the dev server: the cached base environment plus its PORT."""
+    return _base_env() | {"PORT": str(port)}
+
 def get_free_port() -> int:
     """Get a free port for the next test."""
     with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
         s.bind(('', 0))
         return s.getsockname()[1]
 
+def is_port_bindable(port) -> bool:
+    """Checks that a dev server could listen on the port (SO_REUSEADDR, as Node.js uses)."""
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(('', port))
+            return True
+        except OSError:
+            return False
+
+class PortPool:
+    """
+    Hands out dev server ports from a fixed per-worker range in round-robin order.
+    Each pytest-xdist worker gets a disjoint range, so parallel workers never race for
+    the same port, and rotation gives a released port time to leave TIME_WAIT.
+    """
+    def __init__(self, worker_id):
+        worker_index = int(worker_id[2:]) if worker_id.startswith("gw") and worker_id[2:].isdigit() else 0
+        start = DEV_SERVER_PORT_RANGE_START + worker_index * DEV_SERVER_PORTS_PER_WORKER
+        self._ports = collections.deque(range(start, start + DEV_SERVER_PORTS_PER_WORKER))
+
+    def acquire(self) -> int:
+        """Returns the next port in the range that is free, or an OS-assigned port if none are."""
+        for _ in range(len(self._ports)):
+            port = self._ports[0]
+            self._ports.rotate(-1)
+            if is_port_bindable(port):
+                return port
+        return get_free_port()
+
 def load_test_data(csv_filepath=None):
     """Loads test data from a CSV file or uses fallback data."""
     test_cases = []
@@ -82,74 +198,286 @@ def load_test_data(csv_filepath=None):
         print(f"WARNING: CSV file not found: {csv_filepath}. Using fallback for one test.")
         return [("fallback_site_0", LLM_TEST_RESPONSE_FALLBACK, "Fallback: CSV not found")]
 
-    with open(csv_filepath, 'r', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        if not reader.fieldnames:
+    # PERFORMANCE: Parsed cases are persisted in pytest's cache, so unchanged CSVs are not re-parsed
+    # on every run. The key covers the file path, the selected columns and the dialect mode; the file's
+    # mtime and size are stored with the cases and checked on read, so a rewritten CSV replaces its
+    # single entry instead of adding another one.
+    cache = getattr(config, "cache", None)
+    cache_key = None
+    cached_cases = None
+    if cache is not None:
+        csv_stat = os.stat(csv_filepath)
+        cache_id = "|".join([os.path.abspath(csv_filepath), output_response_field, framework_field,
+                             input_question_field, f"sniff={SNIFF_CSV_DIALECT}"])
+        cache_key = f"nextjs_cases/{hashlib.sha1(cache_id.encode('utf-8')).hexdigest()}"
+        cache_entry = cache.get(cache_key, None)
+        if (isinstance(cache_entry, dict) and cache_entry.get("mtime_ns") == csv_stat.st_mtime_ns
+                and cache_entry.get("size") == csv_stat.st_size):
+            cached_cases = cache_entry.get("cases")
+
+    if cached_cases is not None:
+        print(f"INFO: Using cached test cases for {csv_filepath}")
+        test_cases = [tuple(case) for case in cached_cases]
+    else:
+        parsed_cases = parse_csv_test_cases(csv_filepath, output_response_field, framework_field, input_question_field)
+        if parsed_cases is None:
             print(f"WARNING: CSV {csv_filepath} is empty or headerless. Using fallback.")
             return [("fallback_site_1", LLM_TEST_RESPONSE_FALLBACK, "Fallback: CSV empty/headerless")]
-        
-        for i, row in enumerate(reader):
-            tesslate_response = row.get(output_response_field, '')
-            framework = row.get(framework_field, '')
-            input_question = row.get(input_question_field, f"CSV row {i+1}: No input question")
-            if framework == 'Nextjs' and '<Edit filename="' in tesslate_response:
-                test_cases.append((f"site_{i}", tesslate_response, input_question))
+        test_cases = list(parsed_cases)
+        if cache_key:
+            cache.set(cache_key, {"mtime_ns": csv_stat.st_mtime_ns, "size": csv_stat.st_size, "cases": test_cases})
     
     if not test_cases and os.path.exists(csv_filepath):
         pytest.skip(f"No valid Next.js test cases with <Edit> blocks found in {csv_filepath}. Skipping tests.")
     return test_cases
 
-@pytest.fixture(scope="session")
-def golden_template_dir(tmp_path_factory):
+@functools.lru_cache(maxsize=None)
+def parse_csv_test_cases(csv_filepath, output_response_field, framework_field, input_question_field):
     """
-    PERFORMANCE: Creates a "golden image" for EACH pytest-xdist worker.
-    This is done ONCE per worker at the start of the session to avoid I/O bottlenecks.
+    Parses Next.js test cases with <Edit> blocks from a CSV. Returns None if the CSV has no header.
+    PERFORMANCE: Memoized per process, and rows are read with csv.reader using column
+    indices resolved once from the header, so no dict is built per row.
     """
-    # Get the unique worker ID. For a non-parallel run, it will be "master".
-    # This is the key to creating a separate template for each parallel process.
-    worker_id = getattr(pytest, "worker_id", "master")
-    
-    # Create a unique base directory for this specific worker's template.
-    golden_dir_base = tmp_path_factory.mktemp(f"golden_template_{worker_id}")
-    
+    test_cases = []
+    with open(csv_filepath, 'rb') as csvfile:
+        if os.fstat(csvfile.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ) as csv_map:
+            # PERFORMANCE: Search the memory-mapped bytes first. A file that cannot contain any
+            # case is never decoded beyond its header line. The mapping is only searched, never copied.
+            has_candidates = csv_map.find(b'Nextjs') != -1 and csv_map.find(EDIT_BLOCK_MARKER.encode()) != -1
+
+        dialect = csv.excel
+        if SNIFF_CSV_DIALECT:
+            sample = csvfile.read(CSV_SNIFF_SAMPLE_SIZE).decode('utf-8-sig', errors='ignore')
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=',\t;|')
+            except csv.Error:
+                print(f"WARNING: Could not detect the dialect of {csv_filepath}. Assuming standard CSV.")
+            csvfile.seek(0)
+        # PERFORMANCE: Rows are streamed from the file, so memory stays bounded by the largest row.
+        # utf-8-sig strips a leading BOM, which would otherwise end up in the first header name.
+        reader = csv.reader(io.TextIOWrapper(csvfile, encoding='utf-8-sig', newline=''), dialect)
+        header = next(reader, None)
+        if not header:
+            return None
+        output_idx = header.index(output_response_field) if output_response_field in header else None
+        framework_idx = header.index(framework_field) if framework_field in header else None
+        input_idx = header.index(input_question_field) if input_question_field in header else None
+        if output_idx is None or framework_idx is None:
+            return ()
+        if not has_candidates:
+            return ()
+
+        append_test_case = test_cases.append
+        # Blank lines are skipped (as csv.DictReader did) so site identifiers stay stable.
+        for i, row in enumerate(row for row in reader if row):
+            if framework_idx >= len(row) or row[framework_idx] != 'Nextjs':
+                continue
+            tesslate_response = row[output_idx] if output_idx < len(row) else ''
+            if EDIT_BLOCK_MARKER not in tesslate_response:
+                continue
+            if input_idx is not None and input_idx < len(row):
+                input_question = row[input_idx]
+            else:
+                input_question = f"CSV row {i+1}: No input question"
+            append_test_case((f"site_{i}", tesslate_response, input_question))
+    return tuple(test_cases)
+
+def copy_template(src_dir, dest_dir):
+    """
+    Copies the golden template to dest_dir, preserving pnpm's node_modules symlinks.
+    PERFORMANCE: Project sources are copied, but node_modules is rebuilt from hardlinks so
+    its file data is shared with the template. Directories stay private to each test,
+    so a `pnpm install` that adds or removes packages does not touch the template.
+    """
+    shutil.copytree(src_dir, dest_dir, symlinks=True, ignore=shutil.ignore_patterns('node_modules'))
+
+    src_node_modules = os.path.join(src_dir, "node_modules")
+    if not os.path.isdir(src_node_modules):
+        return
+    dest_node_modules = os.path.join(dest_dir, "node_modules")
+    if os.name != 'nt' and shutil.which("cp"):
+        subprocess.run(['cp', '-al', src_node_modules, dest_node_modules], check=True, capture_output=True)
+    else:
+        shutil.copytree(src_node_modules, dest_node_modules, symlinks=True, copy_function=os.link)
+
+def build_golden_template(golden_dir_base, worker_id):
+    """Creates the golden template under golden_dir_base, failing the session on error."""
     print(f"\n[{time.strftime('%H:%M:%S')}] [Worker: {worker_id}] Creating golden template in {golden_dir_base}...")
     
     try:
-        from gen_site_logic import create_golden_template
         template_path = create_golden_template(str(golden_dir_base), NEXTJS_REPO_URL)
         if not template_path:
              pytest.fail(f"[Worker: {worker_id}] Failed to create the golden template.")
-    except ImportError:
-        pytest.fail(f"[Worker: {worker_id}] Error: 'create_golden_template' not found in 'gen_site_logic'.")
     except Exception as e:
         pytest.fail(f"[Worker: {worker_id}] An error occurred during golden template creation: {e}")
 
     print(f"[{time.strftime('%H:%M:%S')}] [Worker: {worker_id}] Golden template created successfully at {template_path}")
+    return template_path
+
+@pytest.fixture(scope="session")
+def golden_template_dir(tmp_path_factory):
+    """
+    PERFORMANCE: Creates a "golden image" ONCE per session at the start to avoid I/O bottlenecks.
+    Under pytest-xdist the template is shared: the first worker builds it while holding a
+    file lock in the common base temp directory, and the other workers reuse it.
+    """
+    # For a non-parallel run, the worker ID is "master".
+    worker_id = getattr(pytest, "worker_id", "master")
+
+    if worker_id == "master":
+        yield build_golden_template(tmp_path_factory.mktemp("golden_template"), worker_id)
+        return
+
+    # The parent of a worker's basetemp is shared by all workers of this run.
+    shared_root = tmp_path_factory.getbasetemp().parent
+    ready_file = shared_root / "golden_template.ready"
+    with FileLock(str(shared_root / "golden_template.lock")):
+        if ready_file.is_file():
+            template_path = ready_file.read_text(encoding='utf-8').strip()
+            print(f"\n[{time.strftime('%H:%M:%S')}] [Worker: {worker_id}] Reusing golden template at {template_path}")
+        else:
+            golden_dir_base = shared_root / "golden_template"
+            golden_dir_base.mkdir(exist_ok=True)
+            template_path = build_golden_template(golden_dir_base, worker_id)
+            ready_file.write_text(template_path, encoding='utf-8')
     yield template_path
 
 
+class TemplateCopyPool:
+    """
+    PERFORMANCE: Prepares copies of the golden template in background threads so that
+    the copy for the next test is usually ready before that test starts.
+    Copies are single-use; acquire() moves a prepared copy into place with os.rename.
+    """
+    def __init__(self, template_dir, pool_dir, total_copies, max_workers):
+        self.template_dir = template_dir
+        self.pool_dir = pool_dir
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="template_copy")
+        self._pending = collections.deque()
+        self._to_schedule = total_copies
+        self._next_index = 0
+        for _ in range(max_workers):
+            self._schedule_copy()
+
+    def _schedule_copy(self):
+        if self._to_schedule <= 0:
+            return
+        self._to_schedule -= 1
+        copy_path = os.path.join(self.pool_dir, f"copy_{self._next_index}")
+        self._next_index += 1
+        self._pending.append((copy_path, self._executor.submit(copy_template, self.template_dir, copy_path)))
+
+    def acquire(self, dest_dir):
+        """Moves a prepared template copy to dest_dir, copying synchronously if the pool is empty."""
+        if not self._pending:
+            copy_template(self.template_dir, dest_dir)
+            return
+        copy_path, future = self._pending.popleft()
+        self._schedule_copy()
+        future.result()
+        os.rename(copy_path, dest_dir)
+
+    def close(self):
+        self._to_schedule = 0
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._pending.clear()
+        shutil.rmtree(self.pool_dir, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def template_copy_pool(tmp_path_factory, request, golden_template_dir):
+    """
+    Session-wide pool of template copies, sized to this worker's share of the collected cases.
+    Under xdist every worker collects all items, so the count is divided by the worker count.
+    Only TEMPLATE_PREFETCH_COPIES are prepared ahead; acquire() copies synchronously if none is ready.
+    """
+    num_cases = sum(1 for item in request.session.items if "site_data_and_tmp_dir" in getattr(item, "fixturenames", ()))
+    worker_count = max(1, int(os.environ.get("PYTEST_XDIST_WORKER_COUNT", "1")))
+    worker_cases = -(-num_cases // worker_count)
+    pool_dir = str(tmp_path_factory.mktemp("template_pool"))
+    pool = TemplateCopyPool(golden_template_dir, pool_dir, total_copies=worker_cases,
+                            max_workers=max(1, min(worker_cases, TEMPLATE_PREFETCH_COPIES)))
+    yield pool
+    pool.close()
+
+
+@pytest.fixture(scope="session")
+def shared_browser(playwright: Playwright):
+    """
+    PERFORMANCE: Launches Chromium once per session (per worker under xdist).
+    Each test still gets an isolated context via new_context().
+    --disable-dev-shm-usage keeps Chromium off the small /dev/shm of Docker containers.
+    """
+    browser = playwright.chromium.launch(headless=True, args=["--disable-dev-shm-usage"])
+    yield browser
+    browser.close()
+
+
+class BackgroundRemover:
+    """
+    PERFORMANCE: Deletes directory trees without blocking test teardown. On POSIX the tree is
+    renamed aside (instant) and removed by a background `rm -rf`; wait() reaps all of them.
+    """
+    def __init__(self):
+        self._processes = []
+
+    def remove(self, path):
+        path = str(path)
+        if os.name == 'nt':
+            shutil.rmtree(path, ignore_errors=True)
+            return
+        trash_path = f"{path}.trash"
+        try:
+            os.rename(path, trash_path)
+            self._processes.append(subprocess.Popen(['rm', '-rf', trash_path],
+                                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        except OSError as e:
+            print(f"Warning: Background removal of {path} failed ({e}), removing synchronously.")
+            shutil.rmtree(path, ignore_errors=True)
+            shutil.rmtree(trash_path, ignore_errors=True)
+
+    def wait(self):
+        for proc in self._processes:
+            proc.wait()
+        self._processes.clear()
+
+
+@pytest.fixture(scope="session")
+def background_remover():
+    """Session-wide background directory remover; pending removals finish at session teardown."""
+    remover = BackgroundRemover()
+    yield remover
+    remover.wait()
+
+
+@pytest.fixture(scope="session")
+def port_pool():
+    """Per-worker pool of dev server ports."""
+    return PortPool(getattr(pytest, "worker_id", "master"))
+
+
 @pytest.fixture(scope="function", params=load_test_data())
-def site_data_and_tmp_dir(tmp_path_factory, request, golden_template_dir):
+def site_data_and_tmp_dir(tmp_path_factory, request, template_copy_pool, background_remover):
     """
-    PERFORMANCE: Uses `git clone` from the local golden template.
+    PERFORMANCE: Takes a pre-made copy of the local golden template from the session pool.
     Also handles automatic cleanup of the test directory, preserving it on failure.
     """
     site_identifier, tesslate_response_content, input_question = request.param
-    test_run_dir = tmp_path_factory.mktemp(f"test_run_{site_identifier.replace('/', '_')}")
-    site_build_path = os.path.join(test_run_dir, f"site_{site_identifier.replace('/', '_')}")
+    safe_identifier = site_identifier.replace('/', '_')
+    test_run_dir = tmp_path_factory.mktemp(f"test_run_{safe_identifier}")
+    site_build_path = os.path.join(test_run_dir, f"site_{safe_identifier}")
 
-    print(f"[{time.strftime('%H:%M:%S')}] Cloning local golden template to {site_build_path} for test {site_identifier}...")
+    print(f"[{time.strftime('%H:%M:%S')}] Copying local golden template to {site_build_path} for test {site_identifier}...")
     try:
-        subprocess.run(['git', 'clone', golden_template_dir, site_build_path], check=True, capture_output=True)
-        git_dir_path = os.path.join(site_build_path, ".git")
-        if os.path.exists(git_dir_path):
-            shutil.rmtree(git_dir_path)
+        template_copy_pool.acquire(site_build_path)
     except subprocess.CalledProcessError as e:
-        pytest.fail(f"Failed to clone local golden template. Stderr: {e.stderr.decode()}")
-    except FileNotFoundError:
-        pytest.fail("'git' command not found.")
+        pytest.fail(f"Failed to copy local golden template. Stderr: {e.stderr.decode(errors='replace')}")
+    except OSError as e:
+        pytest.fail(f"Failed to copy local golden template: {e}")
 
-    print(f"[{time.strftime('%H:%M:%S')}] Local clone complete for {site_identifier}.")
+    print(f"[{time.strftime('%H:%M:%S')}] Local copy complete for {site_identifier}.")
     
     active_subprocesses = [] 
 
@@ -159,16 +487,10 @@ def site_data_and_tmp_dir(tmp_path_factory, request, golden_template_dir):
     # --- POST-TEST CLEANUP (Executed after the test function returns) ---
     print(f"\n[{time.strftime('%H:%M:%S')}] Initiating cleanup for test: '{site_identifier}'")
 
+    # The group is signalled even if pnpm itself has exited: `next start` may still be running.
     for proc in active_subprocesses:
-        if proc.poll() is None:
-            print(f"[{time.strftime('%H:%M:%S')}] Terminating lingering process (PID: {proc.pid})...")
-            proc.terminate()
-            try:
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                print(f"[{time.strftime('%H:%M:%S')}] Process {proc.pid} did not terminate gracefully, killing.")
-                proc.kill()
-                proc.wait(timeout=5)
+        print(f"[{time.strftime('%H:%M:%S')}] Terminating process group of PID {proc.pid}...")
+        terminate_process_tree(proc)
 
     # CORRECTED and MORE ROBUST CLEANUP LOGIC
     # This logic uses the 'rep_call' attribute set by the hook in conftest.py
@@ -177,78 +499,249 @@ def site_data_and_tmp_dir(tmp_path_factory, request, golden_template_dir):
 
     if not test_failed:
         print(f"[{time.strftime('%H:%M:%S')}] Test '{site_identifier}' PASSED. Cleaning up directory {test_run_dir}...")
-        shutil.rmtree(test_run_dir, ignore_errors=True)
+        background_remover.remove(test_run_dir)
     else:
         print(f"[{time.strftime('%H:%M:%S')}] Test '{site_identifier}' FAILED. Directory PRESERVED for analysis at: {test_run_dir}")
 
 
-def wait_for_nextjs_server(url, timeout=180, poll_interval=3):
-    """Polls a URL until it returns a 200 status or times out."""
+def wait_for_process_exit(proc, timeout) -> bool:
+    """
+    Waits up to `timeout` seconds for proc to exit and returns whether it did.
+    PERFORMANCE: On Linux a pidfd is used, so the wakeup happens as soon as the process exits
+    instead of on Popen.wait()'s polling schedule.
+    """
+    if proc.poll() is not None:
+        return True
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except OSError:
+            pidfd = None
+        if pidfd is not None:
+            try:
+                select.select([pidfd], [], [], timeout)
+            finally:
+                os.close(pidfd)
+            return proc.poll() is not None
+    try:
+        proc.wait(timeout=timeout)
+        return True
+    except subprocess.TimeoutExpired:
+        return False
+
+def terminate_process_tree(proc, timeout=3):
+    """
+    Terminates a process started with start_new_session=True (POSIX) or
+    CREATE_NEW_PROCESS_GROUP (Windows) together with its children.
+    Signalling the whole process group also stops the Next.js node process spawned by pnpm.
+    On POSIX the group id is the leader's pid, so the group is reached even after pnpm has exited,
+    and a final SIGKILL removes any member that outlived the leader.
+    """
+    if os.name == 'nt':
+        if proc.poll() is not None:
+            return
+        # CTRL_BREAK_EVENT is delivered to every process in the new process group.
+        proc.send_signal(signal.CTRL_BREAK_EVENT)
+        if not wait_for_process_exit(proc, timeout):
+            print(f"[{time.strftime('%H:%M:%S')}] Process {proc.pid} did not terminate gracefully, killing.")
+            subprocess.run(['taskkill', '/T', '/F', '/PID', str(proc.pid)], capture_output=True)
+            proc.wait(timeout=timeout)
+        return
+
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        # No process of the group is left.
+        proc.poll()
+        return
+    if not wait_for_process_exit(proc, timeout):
+        print(f"[{time.strftime('%H:%M:%S')}] Process {proc.pid} did not terminate gracefully, killing.")
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait(timeout=timeout)
+
+def is_port_open(host, port, timeout=0.2) -> bool:
+    """Checks whether something is accepting TCP connections on host:port (IPv4 or IPv6)."""
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def wait_for_nextjs_server(url, timeout=180, max_poll_interval=0.25, http_timeout=30, process=None):
+    """
+    Waits until a URL returns a 200 status or times out.
+    PERFORMANCE: Probes the port with a cheap TCP connect on an exponential backoff
+    (50ms up to max_poll_interval) and only issues HTTP requests once it is listening.
+    If the server `process` is given, an early exit is reported immediately instead of
+    waiting out the full timeout.
+    """
     print(f"Waiting for Next.js server at {url} (timeout: {timeout}s)...")
+    parsed_url = urllib.parse.urlsplit(url)
+    host, port = parsed_url.hostname or "localhost", parsed_url.port or 80
     start_time = time.time()
+    interval = 0.05
     while time.time() - start_time < timeout:
-        try:
-            response = requests.get(url, timeout=poll_interval)
-            response.raise_for_status()
-            if response.status_code == 200:
-                print(f"Server at {url} is ready.")
-                return True
-        except requests.exceptions.RequestException:
-            time.sleep(poll_interval)
+        if is_port_open(host, port):
+            try:
+                response = _PROBE_SESSION.get(url, timeout=http_timeout)
+                response.raise_for_status()
+                if response.status_code == 200:
+                    print(f"Server at {url} is ready.")
+                    return True
+            except requests.exceptions.RequestException:
+                pass
+        if process is None:
+            time.sleep(interval)
+        elif wait_for_process_exit(process, interval):
+            raise RuntimeError(f"Next.js server process exited with code {process.returncode} before {url} became ready.")
+        interval = min(interval * 1.5, max_poll_interval)
     raise TimeoutError(f"Next.js server at {url} did not become ready within {timeout} seconds.")
 
+def block_nonessential_requests(context, server_url):
+    """
+    PERFORMANCE: Aborts third-party fonts, media and analytics requests so they do not hold up
+    network idle. Requests to the site under test, including its self-hosted fonts, are untouched.
+    """
+    # A regex matcher is evaluated by the browser, so same-origin requests never reach Python.
+    third_party_url = re.compile(r"^(?!" + re.escape(server_url.rstrip('/') + '/') + ")")
+
+    def _handle(route):
+        request = route.request
+        if (request.resource_type in BLOCKED_THIRD_PARTY_RESOURCE_TYPES
+                or any(marker in request.url for marker in BLOCKED_THIRD_PARTY_URL_SUBSTRINGS)):
+            route.abort()
+        else:
+            route.continue_()
+
+    context.route(third_party_url, _handle)
+
+def wait_for_page_settled(page, timeout=15000):
+    """
+    PERFORMANCE: Waits for network idle instead of sleeping a fixed amount of time.
+    A page that never goes fully idle (polling, analytics) is not treated as a failure.
+    """
+    try:
+        page.wait_for_load_state("networkidle", timeout=timeout)
+    except PlaywrightTimeoutError:
+        print(f"Warning: Page did not reach network idle within {timeout}ms, continuing.")
+
+@functools.lru_cache(maxsize=1)
+def ffmpeg_path() -> str | None:
+    """
+    PERFORMANCE: Looks ffmpeg up on PATH once per session instead of running `ffmpeg -version` per call.
+    The resolved path is reused for every ffmpeg invocation so later runs skip the PATH search.
+    """
+    return shutil.which('ffmpeg')
+
+def have_ffmpeg() -> bool:
+    return ffmpeg_path() is not None
+
+VAAPI_RENDER_NODE = "/dev/dri/renderD128"
+
+@functools.lru_cache(maxsize=1)
+def ffmpeg_hwaccel_args() -> tuple:
+    """
+    PERFORMANCE: Probes `ffmpeg -hwaccels` once and returns the input options that offload
+    video decoding to an NVIDIA GPU (cuda) or a VAAPI device, or () for software decoding.
+    """
+    if not have_ffmpeg():
+        return ()
+    try:
+        probe = subprocess.run([ffmpeg_path(), '-hide_banner', '-hwaccels'], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return ()
+    # Output is a "Hardware acceleration methods:" header followed by one method per line.
+    methods = set(probe.stdout.split()[3:])
+    if 'cuda' in methods and shutil.which('nvidia-smi'):
+        return ('-hwaccel', 'cuda')
+    if 'vaapi' in methods and os.path.exists(VAAPI_RENDER_NODE):
+        return ('-hwaccel', 'vaapi', '-hwaccel_device', VAAPI_RENDER_NODE)
+    return ()
+
 def convert_webm_to_gif(webm_path, gif_path):
     """
     Converts a .webm video to a .gif using ffmpeg. This function is compute-intensive.
+    Hardware decoding is used when available, with a software-decoding retry if it fails.
     """
-    try:
-        subprocess.run(['ffmpeg', '-version'], check=True, capture_output=True, text=True)
-    except (FileNotFoundError, subprocess.CalledProcessError) as e:
-        print(f"Warning: FFmpeg not found or not working ({e}). Skipping GIF conversion.")
+    if not have_ffmpeg():
+        print("Warning: FFmpeg not found on PATH. Skipping GIF conversion.")
         return False
-        
-    palette_path = os.path.join(os.path.dirname(gif_path), "palette.png")
-    try:
-        palette_gen_cmd = [
-            'ffmpeg', '-loglevel', 'error', '-i', webm_path, 
-            '-vf', 'fps=10,scale=640:-1:flags=lanczos,palettegen', '-y', palette_path
-        ]
-        subprocess.run(palette_gen_cmd, check=True, capture_output=True, text=True)
-        
+
+    hwaccel_args = ffmpeg_hwaccel_args()
+    attempts = [list(hwaccel_args), []] if hwaccel_args else [[]]
+    for input_args in attempts:
+        # PERFORMANCE: A single ffmpeg run decodes the video once and feeds it to both palettegen and
+        # paletteuse via split, instead of two runs that each decode it and a temporary palette file.
+        # Decoding and the filter graph are spread across cores.
         gif_convert_cmd = [
-            'ffmpeg', '-loglevel', 'error', '-i', webm_path, '-i', palette_path, 
-            '-lavfi', 'fps=10,scale=640:-1:flags=lanczos[x];[x][1:v]paletteuse', 
+            ffmpeg_path(), '-nostdin', '-loglevel', 'error', '-filter_complex_threads', str(os.cpu_count() or 1),
+            '-threads', '0', *input_args, '-i', webm_path,
+            '-filter_complex', '[0:v]fps=10,split[a][b];[a]palettegen[p];[b][p]paletteuse',
             '-loop', '0', '-y', gif_path
         ]
-        subprocess.run(gif_convert_cmd, check=True, capture_output=True, text=True)
-        print(f"GIF conversion successful: {gif_path}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"FFmpeg conversion failed. CMD: {' '.join(e.cmd)}\nStderr: {e.stderr}\nStdout: {e.stdout}")
-    except Exception as e_conv:
-        print(f"Unexpected error during GIF conversion: {e_conv}")
-    finally:
-        if os.path.exists(palette_path):
-            os.remove(palette_path)
+        try:
+            subprocess.run(gif_convert_cmd, check=True, capture_output=True, text=True)
+            print(f"GIF conversion successful: {gif_path}")
+            return True
+        except subprocess.CalledProcessError as e:
+            print(f"FFmpeg conversion failed. CMD: {' '.join(e.cmd)}\nStderr: {e.stderr}\nStdout: {e.stdout}")
+        except Exception as e_conv:
+            print(f"Unexpected error during GIF conversion: {e_conv}")
+            break
     return False
 
+def record_failure_video(browser, url, video_dir, timeout=30000):
+    """
+    Replays the page load in a fresh, recording context after a UI failure and returns the
+    path of the recorded video, or None. Passing runs never pay for video encoding.
+    """
+    context = None
+    page = None
+    try:
+        context = browser.new_context(viewport={'width': 1280, 'height': 720},
+                                      record_video_dir=video_dir,
+                                      record_video_size=VIDEO_RECORD_SIZE)
+        page = context.new_page()
+        page.goto(url, wait_until="domcontentloaded", timeout=timeout)
+        wait_for_page_settled(page, timeout=5000)
+        page.evaluate(SCROLL_AND_SETTLE_JS, None)
+        page.wait_for_timeout(1000)
+    except Exception as e:
+        print(f"Warning: Failure replay did not complete ({e}). Keeping whatever was recorded.")
+    finally:
+        if context:
+            try: context.close()
+            except Exception as e_ctx_close: print(f"Error closing failure replay context: {e_ctx_close}")
+    if page and page.video:
+        video_path = page.video.path()
+        if os.path.exists(video_path):
+            return video_path
+    return None
+
+# PERFORMANCE: Case-insensitive regex avoids building a lowercased copy of every stderr line.
+STDERR_ERROR_RE = re.compile(r"error|failed|typeerror|cannot find|is not assignable", re.IGNORECASE)
+
 def get_error_summary_from_stderr(stderr_text: str, max_lines: int = 10) -> str:
     """Extracts a concise summary of errors from a stderr string."""
     if not stderr_text or not stderr_text.strip():
         return "No STDERR content."
     lines = stderr_text.strip().splitlines()
-    error_keywords = ["error", "failed", "typeerror", "cannot find", "is not assignable"]
-    relevant_lines = [line for line in lines if any(keyword in line.lower() for keyword in error_keywords)]
+    relevant_lines = [line for line in lines if STDERR_ERROR_RE.search(line)]
     if relevant_lines:
         return "\nRelevant STDERR lines:\n" + "\n".join(relevant_lines[:max_lines]) + ("..." if len(relevant_lines) > max_lines else "")
     else:
         return "\nLast STDERR lines:\n" + "\n".join(lines[-max_lines:]) + ("..." if len(lines) > max_lines else "")
 
-def test_generated_nextjs_site(site_data_and_tmp_dir, playwright: Playwright):
+def test_generated_nextjs_site(site_data_and_tmp_dir, shared_browser: Browser, port_pool, request):
     """
     Main test function that orchestrates the entire validation process for a single generated site.
     """
     actual_site_directory, tesslate_response_content, input_question, site_identifier, active_subprocesses = site_data_and_tmp_dir
+    # PERFORMANCE: Video recording and GIF conversion are opt-in via --record-video.
+    record_video = request.config.getoption("record_video")
     
     run_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
@@ -268,7 +761,7 @@ def test_generated_nextjs_site(site_data_and_tmp_dir, playwright: Playwright):
     # The 'site_identifier' argument was missing. It is now passed.
     results = process_generated_site(tesslate_response_content, actual_site_directory, site_identifier)
     
-    allure.attach(json.dumps(results, indent=2, default=lambda o: '<not serializable>'), 
+    allure.attach(dump_results_json(results), 
                   name="Overall Process Summary JSON", attachment_type=allure.attachment_type.JSON)
     
     if results.get("error_messages"):
@@ -303,9 +796,11 @@ def test_generated_nextjs_site(site_data_and_tmp_dir, playwright: Playwright):
                 if stage_output_data:
                     duration_info = f"Duration: {stage_output_data.get('duration', 0):.2f}s"
                     return_code_info = f"Return Code: {stage_output_data.get('returncode', 'N/A')}"
-                    combined_log_output = f"Execution Info:\n  {duration_info}\n  {return_code_info}\n\n"
-                    if stage_output_data.get("stdout"): combined_log_output += f"--- STDOUT ---\n{stage_output_data['stdout']}\n\n"
-                    if stage_output_data.get("stderr"): combined_log_output += f"--- STDERR ---\n{stage_output_data['stderr']}\n"
+                    # PERFORMANCE: Joined once; multi-MB stdout/stderr are not copied by repeated +=.
+                    log_parts = [f"Execution Info:\n  {duration_info}\n  {return_code_info}\n\n"]
+                    if stage_output_data.get("stdout"): log_parts += ["--- STDOUT ---\n", stage_output_data['stdout'], "\n\n"]
+                    if stage_output_data.get("stderr"): log_parts += ["--- STDERR ---\n", stage_output_data['stderr'], "\n"]
+                    combined_log_output = "".join(log_parts)
                     if combined_log_output.strip(): allure.attach(combined_log_output.strip(), name=f"Output Log", attachment_type=allure.attachment_type.TEXT)
                 
                 if success_key:
@@ -338,39 +833,48 @@ def test_generated_nextjs_site(site_data_and_tmp_dir, playwright: Playwright):
         dev_server_process = None
         output_media_dir = os.path.join(actual_site_directory, "test_output_media")
         os.makedirs(output_media_dir, exist_ok=True)
-        port = get_free_port()
+        port = port_pool.acquire()
         server_url = f"http://localhost:{port}"
-        page = None; browser = None; context = None
+        page = None; context = None
         context_closed_for_media = False
+        # PERFORMANCE: Console messages are buffered and attached once, instead of one attachment per message.
+        console_messages = collections.deque(maxlen=CONSOLE_LOG_MAX_MESSAGES)
+        # Server output goes straight to files: an undrained PIPE can fill up and stall the server.
+        logs_dir = os.path.join(actual_site_directory, "test_output_logs")
+        os.makedirs(logs_dir, exist_ok=True)
+        server_stdout_path = os.path.join(logs_dir, "server_stdout.log")
+        server_stderr_path = os.path.join(logs_dir, "server_stderr.log")
+        server_stdout_file = open(server_stdout_path, 'wb')
+        server_stderr_file = open(server_stderr_path, 'wb')
 
         try:
-            with allure.step("Start Dev Server & Navigate"):
+            with allure.step("Start Production Server & Navigate"):
+                # PERFORMANCE: `pnpm start` serves the output of the successful `pnpm Build` stage,
+                # so pages are not compiled on first request as they would be by `pnpm dev`.
                 dev_server_process = subprocess.Popen(
-                   ["pnpm", "dev", "-p", str(port)], cwd=actual_site_directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
-                    env={**os.environ, "PORT": str(port)},
-                    text=True, bufsize=1, creationflags=0 if os.name != 'nt' else subprocess.CREATE_NEW_PROCESS_GROUP
+                   ["pnpm", "start", "-p", str(port)], cwd=actual_site_directory, stdout=server_stdout_file, stderr=server_stderr_file,
+                    env=dev_server_env(port),
+                    creationflags=0 if os.name != 'nt' else subprocess.CREATE_NEW_PROCESS_GROUP,
+                    start_new_session=os.name != 'nt'
                 )
                 active_subprocesses.append(dev_server_process)
                 
-                wait_for_nextjs_server(server_url, timeout=180)
+                wait_for_nextjs_server(server_url, timeout=180, process=dev_server_process)
             
-                browser = playwright.chromium.launch(headless=True)
-                
                 context_args = {'viewport': {'width': 1280, 'height': 720}}
-                if RECORD_VIDEO:
+                if record_video:
                     context_args.update({
                         'record_video_dir': output_media_dir,
-                        'record_video_size': {'width': 1280, 'height': 720}
+                        'record_video_size': VIDEO_RECORD_SIZE
                     })
-                context = browser.new_context(**context_args)
+                context = shared_browser.new_context(**context_args)
+                block_nonessential_requests(context, server_url)
                 
                 page = context.new_page()
                 
                 def _on_console(msg):
                     try:
-                        msg_type = msg.type
-                        msg_text = msg.text()
-                        allure.attach(f"({msg_type}): {msg_text}", name="Browser Console Log", attachment_type=allure.attachment_type.TEXT)
+                        console_messages.append(f"({msg.type}): {msg.text}")
                     except Exception as e:
                         print(f"Error in console listener: {e}")
 
@@ -384,50 +888,58 @@ def test_generated_nextjs_site(site_data_and_tmp_dir, playwright: Playwright):
                 page.on("pageerror", _on_page_error)
 
                 page.goto(server_url, wait_until="domcontentloaded", timeout=90000)
-                page.wait_for_timeout(5000) 
+                wait_for_page_settled(page)
 
             with allure.step("Visual Verification & Page Content Check"):
-                page.evaluate("window.scrollTo({ top: document.body.scrollHeight, behavior: 'smooth' })")
-                page.wait_for_timeout(2000)
-                page.evaluate("window.scrollTo({ top: 0, behavior: 'smooth' })")
-                page.wait_for_timeout(2000)
-
-                page_content_lower = page.content().lower()
-                critical_error_substrings = [
-                    "cannot resolve", "module not found", "typeerror:", "referenceerror:", "syntaxerror:",
-                    "unhandled runtime error", "application error: a client-side exception has occurred",
-                    "server error", "compilation failed", "failed to compile",
-                ]
-                found_errors = [s for s in critical_error_substrings if s in page_content_lower]
+                page.evaluate(SCROLL_AND_SETTLE_JS, None)
+                # Lazy-loaded sections may start fetching once scrolled into view.
+                wait_for_page_settled(page, timeout=5000)
+                if record_video:
+                    # Short floor so the recording still captures the page at the bottom.
+                    page.wait_for_timeout(1000)
+                page.evaluate(SCROLL_AND_SETTLE_JS, 0)
+                if record_video:
+                    page.wait_for_timeout(1000)
+
+                found_errors = page.evaluate(FIND_CRITICAL_ERRORS_JS, CRITICAL_ERROR_SUBSTRINGS)
                 assert not found_errors, f"Found critical error indicators in page content: {', '.join(found_errors)}"
                 
-                screenshot_filename = os.path.join(output_media_dir, f"{site_identifier}_ui_page.png")
-                page.screenshot(path=screenshot_filename, full_page=True)
-                allure.attach.file(screenshot_filename, name=f"Final UI Screenshot", attachment_type=allure.attachment_type.PNG)
+                screenshot_filename = os.path.join(output_media_dir, f"{site_identifier}_ui_page.jpg")
+                page.screenshot(path=screenshot_filename, full_page=True, type="jpeg", quality=SCREENSHOT_JPEG_QUALITY)
+                allure.attach.file(screenshot_filename, name=f"Final UI Screenshot", attachment_type=allure.attachment_type.JPG)
         
         except Exception as e_ui:
             allure.attach(f"{type(e_ui).__name__}: {str(e_ui)}", name="UI Verification Error Details", attachment_type=allure.attachment_type.TEXT)
             if page and not page.is_closed():
-                error_screenshot_path = os.path.join(output_media_dir, f"{site_identifier}_ui_error_page.png")
+                error_screenshot_path = os.path.join(output_media_dir, f"{site_identifier}_ui_error_page.jpg")
                 try:
-                    page.screenshot(path=error_screenshot_path, full_page=True)
-                    allure.attach.file(error_screenshot_path, name=f"UI Error Screenshot", attachment_type=allure.attachment_type.PNG)
+                    page.screenshot(path=error_screenshot_path, full_page=True, type="jpeg", quality=SCREENSHOT_JPEG_QUALITY)
+                    allure.attach.file(error_screenshot_path, name=f"UI Error Screenshot", attachment_type=allure.attachment_type.JPG)
                 except Exception:
                     pass
+            # Recording is off by default; capture a video of the failing page only when it is needed.
+            if not record_video and dev_server_process and dev_server_process.poll() is None:
+                failure_video_path = record_failure_video(shared_browser, server_url, os.path.join(output_media_dir, "failure_video"))
+                if failure_video_path:
+                    allure.attach.file(failure_video_path, name="Failure Replay Video", attachment_type=allure.attachment_type.WEBM)
             raise 
         finally:
             if context:
                 try: context.close()
                 except Exception as e_ctx_media_close: print(f"Error closing playwright context: {e_ctx_media_close}")
-            if browser:
-                try: browser.close()
-                except Exception as e_brw_close: print(f"Error closing playwright browser: {e_brw_close}")
 
-            if RECORD_VIDEO and actual_site_directory and os.path.isdir(output_media_dir):
+            if console_messages:
+                allure.attach("\n".join(console_messages), name="Browser Console Log", attachment_type=allure.attachment_type.TEXT)
+
+            server_stdout_file.close()
+            server_stderr_file.close()
+            attach_server_logs(server_stdout_path, server_stderr_path)
+
+            if record_video and actual_site_directory and os.path.isdir(output_media_dir):
                 with allure.step("Process Recorded Media"):
-                    recorded_videos_list = glob.glob(os.path.join(output_media_dir, "*.webm"))
-                    if recorded_videos_list:
-                        recorded_video_path = recorded_videos_list[0]
+                    # PERFORMANCE: Playwright reports the video path directly, so the media dir is not scanned.
+                    recorded_video_path = page.video.path() if page and page.video else None
+                    if recorded_video_path and os.path.exists(recorded_video_path):
                         allure.attach.file(recorded_video_path, name=f"Recorded Video (raw)", attachment_type=allure.attachment_type.WEBM)
                         gif_output_path = os.path.join(output_media_dir, f"{site_identifier}_animation.gif")
                         if convert_webm_to_gif(recorded_video_path, gif_output_path):